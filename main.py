@@ -1,8 +1,13 @@
 import os
 import sys
 import argparse
+import hashlib
+import math
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import numpy as np
 from PIL import Image, ImageOps
-from collections import Counter
 
 # ------------------------- #
 # GLOBAL CONSTANTS          #
@@ -10,7 +15,22 @@ from collections import Counter
 
 AVERAGE_COLOR = False
 
+# Only every Nth column of the bottom strip is sampled for the edge color;
+# the dominant/average color of a strip is stable under this subsampling
+COLOR_SAMPLE_STRIDE = 4
+
+# Images are processed in separate processes so the Python-level parts of
+# process_image don't serialize on the GIL
+MAX_WORKERS = os.cpu_count() or 1
+# How many images may be processed ahead of the collage that is being filled
+PREFETCH_IMAGES = 2 * MAX_WORKERS
+
 DPI = 300
+
+# zlib level 1 encodes the huge canvas several times faster than the default
+# level 6, for files roughly 20% larger
+PNG_COMPRESS_LEVEL = 1
+JPEG_QUALITY = 92
 CM_TO_PX = lambda cm: round(cm * (DPI / 2.54))
 
 CANVAS_CM = 90
@@ -21,6 +41,12 @@ ROWS = 10
 CELL_WIDTH = CANVAS_SIZE // COLUMNS
 CELL_HEIGHT = CANVAS_SIZE // ROWS
 
+# Top-left (x, y) of each grid cell, filled row by row
+CELL_COORDS = [
+    ((i % COLUMNS) * CELL_WIDTH, (i // COLUMNS) * CELL_HEIGHT)
+    for i in range(COLUMNS * ROWS)
+]
+
 IMAGE_WIDTH_CM = 5.4
 IMAGE_HEIGHT_CM = 8.56
 EXTEND_COLOR_CM = 0.15
@@ -28,6 +54,7 @@ WHITE_BORDER_CM = 0.00
 
 EXTEND_TOP_BOTTOM = 30
 EXTEND_LEFT_RIGHT = 15
+EXTEND_EDGES = EXTEND_TOP_BOTTOM > 0 or EXTEND_LEFT_RIGHT > 0
 
 BASE_IMAGE_WIDTH_PX = CM_TO_PX(IMAGE_WIDTH_CM)
 BASE_IMAGE_HEIGHT_PX = CM_TO_PX(IMAGE_HEIGHT_CM)
@@ -41,33 +68,63 @@ DESIGN_FINAL_HEIGHT_PX = (
     BASE_IMAGE_HEIGHT_PX + 2 * (EXTEND_COLOR_PX + WHITE_BORDER_PX)
 )
 
+TARGET_CELL = (CELL_WIDTH, CELL_HEIGHT)
+
+# Tiles are downscaled, where BILINEAR looks near-identical to LANCZOS at a
+# fraction of the cost. REDUCING_GAP lets Pillow shrink large sources with a
+# cheap integer reduce() first, then run the filter on the small remainder.
+RESAMPLE_FILTER = Image.Resampling.BILINEAR
+REDUCING_GAP = 2.0
+
+# Large JPEGs are decoded at a reduced DCT scale (1/2, 1/4, 1/8) as long as
+# the result stays at least this big, which is plenty for one cell
+JPEG_DRAFT_SIZE = (CELL_WIDTH * 2, CELL_HEIGHT * 2)
+
+# Each design is center-cropped to the cell's aspect ratio. The crop box is
+# the same for every image, so keep it as fractions of the design size and
+# let process_image crop + resize to the cell in a single resample.
+DESIGN_ASPECT = DESIGN_FINAL_WIDTH_PX / DESIGN_FINAL_HEIGHT_PX
+CELL_ASPECT = CELL_WIDTH / CELL_HEIGHT
+if DESIGN_ASPECT > CELL_ASPECT:
+    KEEP_WIDTH = CELL_ASPECT / DESIGN_ASPECT
+    FIT_CROP_BOX = ((1 - KEEP_WIDTH) / 2, 0.0, (1 + KEEP_WIDTH) / 2, 1.0)
+else:
+    KEEP_HEIGHT = DESIGN_ASPECT / CELL_ASPECT
+    FIT_CROP_BOX = (0.0, (1 - KEEP_HEIGHT) / 2, 1.0, (1 + KEEP_HEIGHT) / 2)
+
 
 # ------------------------- #
 # HELPER: GET BOTTOM AVG    #
 # ------------------------- #
 
+def get_bottom_strip_pixels(image, strip_height=1):
+    """
+    Return the bottom `strip_height` rows of the image as an (N, 3) RGB
+    array, keeping every COLOR_SAMPLE_STRIDE-th column.
+    Cropping before converting keeps the conversion to the strip only,
+    instead of an extra pass over the whole image.
+    """
+    bottom_strip = image.crop(
+        (0, image.height - strip_height, image.width, image.height)
+    ).convert('RGB')
+    pixels = np.asarray(bottom_strip, dtype=np.uint8)
+    return pixels[:, ::COLOR_SAMPLE_STRIDE].reshape(-1, 3)
+
+
 def get_bottom_average_color(image, strip_height=1):
     """
     Return the average color (R, G, B) of the bottom strip
     of `strip_height` pixels.
     """
-    image = image.convert('RGB')
-    bottom_strip = image.crop(
-        (0, image.height - strip_height, image.width, image.height)
-    )
-    pixels = list(bottom_strip.getdata())
+    pixels = get_bottom_strip_pixels(image, strip_height)
 
     num_pixels = len(pixels)
     if num_pixels == 0:
         return (255, 255, 255)  # fallback
 
-    sum_r = sum(p[0] for p in pixels)
-    sum_g = sum(p[1] for p in pixels)
-    sum_b = sum(p[2] for p in pixels)
-
-    avg_r = sum_r // num_pixels
-    avg_g = sum_g // num_pixels
-    avg_b = sum_b // num_pixels
+    # One vector reduction per channel; integer floor division as before
+    sums = pixels.sum(axis=0, dtype=np.uint64)
+    avg_r, avg_g, avg_b = (int(total) // num_pixels for total in sums)
 
     return (avg_r, avg_g, avg_b)
 
@@ -77,20 +134,26 @@ def get_bottom_color(image, strip_height=1):
     Return the most common color in the bottom strip (height = strip_height pixels).
     If it turns out to be all white, default to white.
     """
-    image = image.convert('RGB')
-
-    bottom_strip = image.crop(
-        (0, image.height - strip_height, image.width, image.height)
+    pixels = get_bottom_strip_pixels(image, strip_height)
+
+    # All-white strips are common on white artwork; one min() settles those
+    # without packing and sorting every pixel in np.unique
+    if pixels.size == 0 or pixels.min() == 255:
+        return (255, 255, 255)
+
+    # Pack each RGB triple into one uint32 so np.unique counts colors in C
+    packed = (
+        (pixels[:, 0].astype(np.uint32) << 16)
+        | (pixels[:, 1].astype(np.uint32) << 8)
+        | pixels[:, 2]
     )
-    pixels = list(bottom_strip.getdata())
+    values, counts = np.unique(packed, return_counts=True)
 
-    non_white_pixels = [p for p in pixels if p != (255, 255, 255)]
-    if non_white_pixels:
-        most_common_color = Counter(non_white_pixels).most_common(1)[0][0]
-    else:
-        most_common_color = (255, 255, 255)
-
-    return most_common_color
+    # The strip is not all white (checked above); ignore any white pixels
+    non_white = values != 0xFFFFFF
+    values = values[non_white]
+    most_common = int(values[counts[non_white].argmax()])
+    return ((most_common >> 16) & 0xFF, (most_common >> 8) & 0xFF, most_common & 0xFF)
 
 
 # ------------------------- #
@@ -101,71 +164,172 @@ def process_image(file_path):
     """
     Process each image by extending top/bottom + left/right with
     a color based on the bottom strip of the original image.
-    Then optionally add a white border, then resize.
+    Then optionally add a white border, then crop + resize to one cell.
     """
     image = Image.open(file_path)
 
-    # Choose either average color or most common color:
-    if AVERAGE_COLOR:
-        bottom_avg_color = get_bottom_average_color(image, strip_height=5)
-    else:
-        bottom_avg_color = get_bottom_color(image, strip_height=5)
-
-    extended_image = ImageOps.expand(
-        image,
-        border=(EXTEND_LEFT_RIGHT, EXTEND_TOP_BOTTOM, EXTEND_LEFT_RIGHT, EXTEND_TOP_BOTTOM),
-        fill=bottom_avg_color
-    )
-
+    # Edge sizes are in source pixels, so scale them with any draft decode
+    scale = 1.0
+    if image.format == "JPEG":
+        full_width = image.width
+        image.draft("RGB", JPEG_DRAFT_SIZE)
+        scale = image.width / full_width
+
+    edge_color = (255, 255, 255)
+    extend_left_right = extend_top_bottom = 0
+
+    if EXTEND_EDGES:
+        strip_height = max(1, round(5 * scale))
+        extend_left_right = round(EXTEND_LEFT_RIGHT * scale)
+        extend_top_bottom = round(EXTEND_TOP_BOTTOM * scale)
+
+        # Choose either average color or most common color:
+        if AVERAGE_COLOR:
+            edge_color = get_bottom_average_color(image, strip_height=strip_height)
+        else:
+            edge_color = get_bottom_color(image, strip_height=strip_height)
+
+    # The RGB edge color can't fill single-band or palette images (L, P, ...).
+    # RGB and RGBA are used as-is: RGBA takes the fill directly and is
+    # flattened when pasted onto the canvas, so it needs no extra copy here.
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGB")
+
+    # Zero-width borders would only allocate and copy an identical image
+    extended_image = image
     if WHITE_BORDER_PX > 0:
-        extended_image = ImageOps.expand(extended_image, border=WHITE_BORDER_PX, fill='white')
+        # Build both bands in one allocation: white canvas, edge color
+        # inside the border, then the source on top
+        border = WHITE_BORDER_PX
+        inner_width = image.width + 2 * extend_left_right
+        inner_height = image.height + 2 * extend_top_bottom
+        extended_image = Image.new(
+            "RGB",
+            (inner_width + 2 * border, inner_height + 2 * border),
+            "white"
+        )
+        if extend_left_right or extend_top_bottom:
+            extended_image.paste(
+                edge_color,
+                (border, border, border + inner_width, border + inner_height)
+            )
+        extended_image.paste(image, (border + extend_left_right, border + extend_top_bottom))
+    elif extend_left_right or extend_top_bottom:
+        extended_image = ImageOps.expand(
+            image,
+            border=(extend_left_right, extend_top_bottom, extend_left_right, extend_top_bottom),
+            fill=edge_color
+        )
 
-    # Resize to final dimension
-    # (If you use ImageOps.fit here, it may crop. We'll do a simple resize.)
+    # Same result as resizing to the design size and then fitting it to the
+    # cell, but done as one resample straight from the source pixels.
+    width, height = extended_image.size
+    left, top, right, bottom = FIT_CROP_BOX
     resized = extended_image.resize(
-        (DESIGN_FINAL_WIDTH_PX, DESIGN_FINAL_HEIGHT_PX),
-        Image.Resampling.LANCZOS
+        TARGET_CELL,
+        RESAMPLE_FILTER,
+        box=(left * width, top * height, right * width, bottom * height),
+        reducing_gap=REDUCING_GAP
     )
     return resized
 
 
+def file_digest(file_path):
+    """
+    Return a hash of the file's bytes, used to spot duplicate inputs.
+    """
+    digest = hashlib.blake2b()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def iter_processed_images(executor, files):
+    """
+    Yield processed images in file order, keeping at most PREFETCH_IMAGES
+    in flight. Processing overlaps with pasting, and only a bounded number
+    of tiles is held in memory instead of the whole input set.
+    Files with identical contents are processed once and the tile is
+    reused. Only files that share their size with another input are
+    hashed; a file with a unique size cannot be a duplicate, so it is
+    never hashed or retained.
+    """
+    sizes = [os.stat(file_path).st_size for file_path in files]
+    size_counts = Counter(sizes)
+    digests = [
+        file_digest(file_path) if size_counts[size] > 1 else None
+        for file_path, size in zip(files, sizes)
+    ]
+    uses_left = Counter(digest for digest in digests if digest is not None)
+    shared = {}
+
+    pending = deque()
+    for file_path, digest in zip(files, digests):
+        if digest is None:
+            future = executor.submit(process_image, file_path)
+        else:
+            future = shared.pop(digest, None)
+            if future is None:
+                future = executor.submit(process_image, file_path)
+
+            # Keep the tile only while later files still need it
+            uses_left[digest] -= 1
+            if uses_left[digest]:
+                shared[digest] = future
+
+        pending.append(future)
+        if len(pending) >= PREFETCH_IMAGES:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
 # ------------------------- #
 #  FINAL COLLAGE CREATION   #
 # ------------------------- #
 
-def create_collage(processed_images, canvas_index, output_format):
+_canvas = None
+
+
+def get_blank_canvas():
+    """
+    Return the shared 90x90 cm canvas, cleared to white.
+    It is allocated on first use and reused for every later collage,
+    which avoids faulting in a fresh ~340MB image per batch.
+    """
+    global _canvas
+    if _canvas is None:
+        _canvas = Image.new("RGB", (CANVAS_SIZE, CANVAS_SIZE), (255, 255, 255))
+    else:
+        _canvas.paste((255, 255, 255), (0, 0, CANVAS_SIZE, CANVAS_SIZE))
+    return _canvas
+
+
+def create_collage(canvas, processed_images, canvas_index, output_format):
     """
-    Arrange processed images on a 90x90 cm canvas in a grid.
+    Arrange processed images on a blank canvas in a grid.
     Then export based on the chosen output_format.
     """
-    canvas = Image.new("RGB", (CANVAS_SIZE, CANVAS_SIZE), (255, 255, 255))
-
-    for i, img in enumerate(processed_images):
-        row = i // COLUMNS
-        col = i % COLUMNS
-        x = col * CELL_WIDTH
-        y = row * CELL_HEIGHT
-
-        # Fill the cell entirely by cropping if needed
-        fitted_img = ImageOps.fit(
-            img,
-            (CELL_WIDTH, CELL_HEIGHT),
-            method=Image.Resampling.LANCZOS,
-            centering=(0.5, 0.5)
-        )
-        canvas.paste(fitted_img, (x, y))
+    # Images already come out of process_image at the cell size
+    for img, (x, y) in zip(processed_images, CELL_COORDS):
+        canvas.paste(img, (x, y))
 
     # Determine output path based on format
     base_name = f"final_canvas_{canvas_index}"
     if output_format == "png":
         out_path = os.path.join("output", base_name + ".png")
-        canvas.save(out_path, "PNG")
+        canvas.save(out_path, "PNG", compress_level=PNG_COMPRESS_LEVEL)
+    elif output_format == "jpg":
+        out_path = os.path.join("output", base_name + ".jpg")
+        canvas.save(out_path, "JPEG", quality=JPEG_QUALITY, dpi=(DPI, DPI))
     elif output_format == "pdf":
         out_path = os.path.join("output", base_name + ".pdf")
-        canvas.save(out_path, "PDF", resolution=300)
+        canvas.save(out_path, "PDF", resolution=DPI)
     elif output_format == "svg":
         png_path = os.path.join("output", base_name + "_temp.png")
-        canvas.save(png_path, "PNG")
+        canvas.save(png_path, "PNG", compress_level=PNG_COMPRESS_LEVEL)
 
         svg_path = os.path.join("output", base_name + ".svg")
         embed_png_in_svg(png_path, svg_path, canvas.width, canvas.height)
@@ -174,11 +338,11 @@ def create_collage(processed_images, canvas_index, output_format):
         out_path = svg_path
     elif output_format == "ai":
         out_path = os.path.join("output", base_name + ".eps")
-        canvas.save(out_path, "EPS")
+        embed_raster_in_eps(canvas, out_path)
     else:
         # Default fallback
         out_path = os.path.join("output", base_name + ".png")
-        canvas.save(out_path, "PNG")
+        canvas.save(out_path, "PNG", compress_level=PNG_COMPRESS_LEVEL)
 
     print(f"Collage created successfully at {out_path}.")
 
@@ -187,28 +351,84 @@ def embed_png_in_svg(png_path, svg_path, width_px, height_px):
     """
     Minimal function to embed a PNG in an SVG.
     This is not a true vector conversion — just a raster data embed.
+    The PNG is base64-encoded in chunks, so memory use stays small
+    regardless of the PNG size.
     """
     import base64
 
-    with open(png_path, "rb") as f:
-        encoded = base64.b64encode(f.read()).decode("ascii")
-
     # For a 300 DPI image, 1 inch = 300 px. If you want real size in mm/cm,
     # you'd do some calculations. We'll just put the same px as the <svg width/height>.
-    svg_content = f"""<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+    svg_header = f"""<?xml version="1.0" encoding="UTF-8" standalone="no"?>
 <svg
     xmlns="http://www.w3.org/2000/svg"
     width="{width_px}"
     height="{height_px}"
     version="1.1">
-  <image href="data:image/png;base64,{encoded}"
+  <image href="data:image/png;base64,"""
+    svg_footer = f""""
          x="0" y="0"
          width="{width_px}"
          height="{height_px}" />
 </svg>
 """
-    with open(svg_path, "w", encoding="utf-8") as svg_file:
-        svg_file.write(svg_content)
+    # A multiple of 3 bytes, so no chunk but the last gets base64 padding
+    chunk_size = 57 * 1024
+
+    with open(png_path, "rb") as f, open(svg_path, "w", encoding="utf-8") as svg_file:
+        svg_file.write(svg_header)
+        while chunk := f.read(chunk_size):
+            svg_file.write(base64.b64encode(chunk).decode("ascii"))
+        svg_file.write(svg_footer)
+
+
+def embed_raster_in_eps(image, eps_path):
+    """
+    Minimal function to write an RGB image as an EPS file.
+    The pixels are embedded as raw binary image data, a band of rows at a
+    time, instead of hex-encoding them through Pillow's EPS writer.
+    """
+    width, height = image.size
+
+    # EPS sizes are in points (1/72 inch); keep the print size at DPI
+    width_pt = width * 72 / DPI
+    height_pt = height * 72 / DPI
+
+    image_operator = b"collage_image image\n"
+    data_size = len(image_operator) + width * height * 3
+
+    header = f"""%!PS-Adobe-3.0 EPSF-3.0
+%%BoundingBox: 0 0 {math.ceil(width_pt)} {math.ceil(height_pt)}
+%%HiResBoundingBox: 0 0 {width_pt:.3f} {height_pt:.3f}
+%%LanguageLevel: 2
+%%EndComments
+gsave
+{width_pt:.3f} {height_pt:.3f} scale
+/DeviceRGB setcolorspace
+/collage_image <<
+  /ImageType 1
+  /Width {width}
+  /Height {height}
+  /BitsPerComponent 8
+  /Decode [0 1 0 1 0 1]
+  /ImageMatrix [{width} 0 0 -{height} 0 {height}]
+  /DataSource currentfile
+>> def
+%%BeginData: {data_size} Binary Bytes
+"""
+    footer = """
+%%EndData
+grestore
+%%EOF
+"""
+    with open(eps_path, "wb") as eps_file:
+        eps_file.write(header.encode("ascii"))
+        eps_file.write(image_operator)
+        # Copy out a few MB at a time rather than the whole canvas at once
+        band_rows = 256
+        for top in range(0, height, band_rows):
+            band = image.crop((0, top, width, min(top + band_rows, height)))
+            eps_file.write(band.tobytes())
+        eps_file.write(footer.encode("ascii"))
 
 
 # ------------------------- #
@@ -219,9 +439,9 @@ def parse_args():
     parser = argparse.ArgumentParser(description="Create collage and export in various formats.")
     parser.add_argument(
         "--format",
-        choices=["png", "pdf", "svg", "ai"],
+        choices=["png", "jpg", "pdf", "svg", "ai"],
         default="png",
-        help="Output format (png, pdf, svg, ai). Default is png."
+        help="Output format (png, jpg, pdf, svg, ai). Default is png."
     )
     return parser.parse_args()
 
@@ -237,22 +457,24 @@ def main():
 
         # Gather all .png/.jpg/.jpeg files
         files = [
-            os.path.join(input_dir, file)
-            for file in os.listdir(input_dir)
-            if file.lower().endswith((".png", ".jpg", ".jpeg"))
+            entry.path
+            for entry in os.scandir(input_dir)
+            if entry.is_file() and entry.name.lower().endswith((".png", ".jpg", ".jpeg"))
         ]
 
-        # Process each image
-        processed_images = [process_image(file) for file in files]
-
-        # Create and save the final collage(s)
+        # Process images in the background and paste them as they arrive,
+        # saving each collage once it is full
         max_images_per_canvas = COLUMNS * ROWS
-        for i in range(0, len(processed_images), max_images_per_canvas):
-            create_collage(
-                processed_images[i:i + max_images_per_canvas],
-                i // max_images_per_canvas,
-                output_format
-            )
+        canvas_count = -(-len(files) // max_images_per_canvas)
+        with ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            processed_images = iter_processed_images(executor, files)
+            for canvas_index in range(canvas_count):
+                create_collage(
+                    get_blank_canvas(),
+                    islice(processed_images, max_images_per_canvas),
+                    canvas_index,
+                    output_format
+                )
 
     except Exception as e:
         print(f"Error: {e}")